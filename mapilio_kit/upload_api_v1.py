@@ -1,6 +1,7 @@
 import json
 
 import requests
+import requests.adapters
 import os
 import io
 import typing as T
@@ -14,6 +15,19 @@ LOG = logging.getLogger(__name__)
 DEFAULT_CHUNK_SIZE = 1024 * 1024 * 64
 
 
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    # retries are handled by the callers
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# shared across chunks and retries so connections are kept alive
+SESSION = _build_session()
+
+
 class UploadService:
     user_access_token: str
     # This amount of data that will be loaded to memory
@@ -33,7 +47,7 @@ class UploadService:
         headers = {
             "Authorization": f"OAuth {self.user_access_token}"
         }
-        resp = requests.get(
+        resp = SESSION.get(
             f"{MAPILIO_UPLOAD_ENDPOINT_ZIP}?fileName={self.session_key}&email={email}",
             headers=headers
         )
@@ -55,14 +69,16 @@ class UploadService:
             raise ValueError("Expect positive chunk size")
 
         email = user_items['SettingsUsername']
+        # when the caller passes the offset, data is expected to be positioned at it already
         if offset is None:
             offset = self.fetch_offset(email=email)
+            data.seek(offset, io.SEEK_SET)
 
-        data.seek(offset, io.SEEK_CUR) # noqa
-
-
+        # read every chunk into the same buffer instead of allocating a new one per read
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
         while True:
-            chunk = data.read(chunk_size)
+            chunk = view[:data.readinto(buffer)]
             files = {'chunk': (self.session_key, chunk, "multipart/form-data")}
             headers = {
                 'Connection': "keep-alive",
@@ -74,7 +90,7 @@ class UploadService:
                 "project-key": project_key if project_key else None
             }
             try:
-                resp = requests.post(
+                resp = SESSION.post(
                     f"{MAPILIO_UPLOAD_ENDPOINT_ZIP}",
                     headers=headers,
                     files=files
@@ -90,6 +106,10 @@ class UploadService:
                         LOG.info(f"Images has installed.")
                         return response_dict["hash"]
             except requests.exceptions.HTTPError as e:
+                # leave throttling and server errors to the caller's retry with backoff,
+                # rather than sending the next chunk right away
+                if e.response.status_code == 429 or e.response.status_code >= 500:
+                    raise
                 print(e.response.text)
 
 
@@ -108,7 +128,7 @@ class UploadService:
             data["organization_id"] = organization_id
             data["project_id"] = project_id
 
-        resp = requests.post(
+        resp = SESSION.post(
             f"{MAPILIO_UPLOAD_ENDPOINT_ZIP}/finish_upload", headers=headers, json=data
         )
 
@@ -137,12 +157,14 @@ class FakeUploadService(UploadService):
     ) -> str:
         if offset is None:
             offset = self.fetch_offset()
+            data.seek(offset, io.SEEK_SET)
         os.makedirs(FakeUploadService.upload_path, exist_ok=True)
         filename = os.path.join(FakeUploadService.upload_path, self.session_key)
         with open(filename, "ab") as fp:
-            data.seek(offset, io.SEEK_CUR)
+            buffer = bytearray(chunk_size)
+            view = memoryview(buffer)
             while True:
-                chunk = data.read(chunk_size)
+                chunk = view[:data.readinto(buffer)]
                 if not chunk:
                     break
                 fp.write(chunk)
@@ -1,13 +1,18 @@
+import collections
+import concurrent.futures
 import io
 import json
 import uuid
 from typing import Optional, Iterable, Tuple, Any
 import typing as T
 import os
+import random
 import tempfile
 import hashlib
+import email.utils
 import logging
-from datetime import datetime
+import math
+from datetime import datetime, timezone
 
 import time
 import zipfile
@@ -21,9 +26,13 @@ from . import types_fmt as types
 from .login import wrap_http_exception
 from .api_v1 import MAPILIO_GRAPH_API_ENDPOINT_UPLOAD
 
-MIN_CHUNK_SIZE = 1024 * 1024 * 2  # 32MB
-MAX_CHUNK_SIZE = 1024 * 1024 * 16  # 64MB
+MIN_CHUNK_SIZE = 1024 * 1024 * 2  # 2MB
+MAX_CHUNK_SIZE = 1024 * 1024 * 16  # 16MB
 MAX_UPLOAD_SIZE = 1024 * 1024 * 750  # 750MB
+MAX_IN_MEMORY_ZIP_SIZE = 1024 * 1024 * 128  # 128MB
+WRITE_BUFFER_SIZE = 1024 * 1024  # 1MB
+MAX_RETRY_AFTER = 60 * 5  # 5 minutes
+READ_AHEAD_SIZE = 32
 LOG = logging.getLogger(__name__)
 
 
@@ -31,40 +40,55 @@ def _find_root_dir(file_list: Iterable[str]) -> Optional[str]:
     """
     find the common root path
     """
-    dirs = set()
-    for path in file_list:
-        dirs.add(os.path.dirname(path))
-    if len(dirs) == 0:
+    try:
+        return os.path.commonpath([os.path.dirname(path) for path in file_list])
+    except ValueError:
+        # empty list, or a mix of absolute and relative paths
         return None
-    elif len(dirs) == 1:
-        return list(dirs)[0]
-    else:
-        return _find_root_dir(dirs)
 
 
 def _group_sequences_by_uuid(
         image_descs: T.List[types.ImageDescriptionJSON],
 ) -> T.Dict[str, T.Dict[str, types.FinalImageDescription]]:
     sequences: T.Dict[str, T.Dict[str, types.FinalImageDescription]] = {}
-    missing_sequence_uuid = str(uuid.uuid4())
+    missing_sequence_uuid = None
     for desc in image_descs:
-        sequence_uuid = desc.get("SequenceUUID", missing_sequence_uuid)
+        sequence_uuid = desc.get("SequenceUUID")
+        if sequence_uuid is None:
+            if missing_sequence_uuid is None:
+                missing_sequence_uuid = str(uuid.uuid4())
+            sequence_uuid = missing_sequence_uuid
         sequence = sequences.setdefault(sequence_uuid, {})
-        desc_without_filename = {**desc}
-        del desc_without_filename["filename"]
+        desc_without_filename = {k: v for k, v in desc.items() if k != "filename"}
         sequence[os.path.join(desc["path"], desc["filename"])] = T.cast(
             types.FinalImageDescription, desc_without_filename
         )
     return sequences
 
 
+def _list_files(dirname: str) -> T.Set[str]:
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
+
+
 def _validate_descs(image_dir: str, image_descs: T.List[types.ImageDescriptionJSON]):
+    # build the validator once instead of resolving the schema for every desc
+    validator = jsonschema.Draft7Validator(types.ImageDescriptionJSONSchema)
+    # list each image directory once instead of stat-ing every image
+    files_by_dir: T.Dict[str, T.Set[str]] = {}
     for desc in image_descs:
-        jsonschema.validate(instance=desc, schema=types.ImageDescriptionJSONSchema)
-    for desc in image_descs:
+        validator.validate(desc)
         dirpath = os.path.join(desc["path"], desc["filename"])
         abspath = os.path.join(image_dir, dirpath)
-        if not os.path.isfile(abspath):
+        dirname, basename = os.path.split(abspath)
+        if dirname not in files_by_dir:
+            files_by_dir[dirname] = _list_files(dirname)
+        # fall back to stat for names the listing misses, e.g. a different
+        # case on case-insensitive filesystems
+        if basename not in files_by_dir[dirname] and not os.path.isfile(abspath):
             raise RuntimeError(f"Image path {abspath} not found")
 
 
@@ -75,6 +99,7 @@ def upload_desc(
         project_key: T.Optional[str] = None,
         seq_info: dict = None,
         backup_path: str = os.path.join(os.path.expanduser('~'), '.config', 'mapilio', 'configs'),
+        description_chunk: T.Optional[T.List[types.ImageDescriptionJSON]] = None,
 ):
     """
     :param image_desc: description file path
@@ -83,6 +108,7 @@ def upload_desc(
     :param project_key: which organization key use project key to upload description json
     :param seq_info: information sequence data such as count and entity size, hash
     :param backup_path:
+    :param description_chunk: descriptions of the uploaded sequence, filtered from image_desc if not given
     :return: None
     """
 
@@ -90,11 +116,14 @@ def upload_desc(
         os.makedirs(os.path.join(backup_path, user_items['SettingsUsername']))
     export_backup_path = os.path.join(backup_path, user_items['SettingsUsername'])
 
-    summary = list(image_desc).pop()
-    image_desc = list(image_desc)[:-1]
     sequence_uuid = next(iter(seq_info)) # get first key from dict
-    description_chunk = [desc for desc in image_desc if
-                         desc.get("SequenceUUID") == sequence_uuid]
+    if description_chunk is None:
+        image_desc = list(image_desc)
+        summary = image_desc.pop()
+        description_chunk = [desc for desc in image_desc if
+                             desc.get("SequenceUUID") == sequence_uuid]
+    else:
+        summary = image_desc[-1]
     summary['Information']['failed_images'] = summary['Information']['total_images'] - seq_info[sequence_uuid]['count'] # noqa
     summary['Information']['total_images'] = seq_info[sequence_uuid]['count'] # noqa
     summary['Information']['processed_images'] = seq_info[sequence_uuid]['count'] # noqa
@@ -117,10 +146,13 @@ def upload_desc(
 
     current_time = "{:%Y_%m_%d_%H_%M_%S}".format(datetime.now())
     try:
-        resp = requests.request("POST", url=MAPILIO_GRAPH_API_ENDPOINT_UPLOAD, headers=headers, data=payload)
+        # send bytes so requests does not re-encode or sniff the payload
+        resp = upload_api_v1.SESSION.post(MAPILIO_GRAPH_API_ENDPOINT_UPLOAD, headers=headers,
+                                          data=payload.encode("utf-8"))
         with open(os.path.join(export_backup_path,
                                f'{current_time}_backup_request_{organization_key}_{project_key}.json'), 'w') as f:
-            json.dump(payload, f)
+            # payload is already JSON text
+            f.write(payload)
         resp.raise_for_status()
         if not resp.status_code // 100 == 2:
             LOG.warning(resp.text)
@@ -143,6 +175,12 @@ def upload_image_dir_and_description(
     _validate_descs(image_dir, image_descs)
 
     sequences = _group_sequences_by_uuid(image_descs)
+
+    # group once instead of filtering all descs for every sequence; the last desc is the summary
+    descs_by_uuid: T.Dict[T.Optional[str], T.List[types.ImageDescriptionJSON]] = collections.defaultdict(list)
+    for desc in descs[:-1]:
+        descs_by_uuid[desc.get("SequenceUUID")].append(desc)
+
     for sequence_idx, images in enumerate(sequences.values()):
         LOG.info(f"Images has started for uploading.")
         sequence_information = _zip_and_upload_single_sequence(
@@ -161,7 +199,8 @@ def upload_image_dir_and_description(
             user_items=user_items,
             organization_key=organization_key if organization_key else None,
             project_key=project_key if project_key else None,
-            seq_info=sequence_information
+            seq_info=sequence_information,
+            description_chunk=descs_by_uuid.get(next(iter(sequence_information)), []),
         )
 
 
@@ -176,9 +215,9 @@ def zip_image_dir(
         zip_filename_wip = os.path.join(
             zip_dir, f"mapilio_tools_{sequence_uuid}.{os.getpid()}.wip"
         )
-        with open(zip_filename_wip, "wb") as fp:
-            sequence_md5 = _zip_sequence(image_dir, sequence, fp)
-        zip_filename = os.path.join(zip_dir, f"mapilio_tools_{sequence_md5}.zip")
+        with open(zip_filename_wip, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+            sequence_hash, _ = _zip_sequence(image_dir, sequence, fp)
+        zip_filename = os.path.join(zip_dir, f"mapilio_tools_{sequence_hash}.zip")
         os.rename(zip_filename_wip, zip_filename)
 
 
@@ -186,15 +225,33 @@ class Notifier:
     def __init__(self, sequnece_info: T.Dict):
         self.uploaded_bytes = 0
         self.sequence_info = sequnece_info
+        # updated in place per chunk; ipc.send serializes it right away
+        self._payload = {"chunk_size": 0, "uploaded_bytes": 0, **sequnece_info}
 
     def notify_progress(self, chunk: bytes, _):
         self.uploaded_bytes += len(chunk)
-        payload = {
-            "chunk_size": len(chunk),
-            "uploaded_bytes": self.uploaded_bytes,
-            **self.sequence_info,
-        }
-        ipc.send("upload", payload)
+        self._payload["chunk_size"] = len(chunk)
+        self._payload["uploaded_bytes"] = self.uploaded_bytes
+        ipc.send("upload", self._payload)
+
+
+def _read_image(
+        image_dir: str, file: str, desc: T.Optional[types.FinalImageDescription] = None
+) -> T.Tuple[bytes, bytes]:
+    """
+    read the image bytes to be zipped and their digest, writing desc into the
+    image description EXIF tag if given
+    """
+    abspath = os.path.join(image_dir, file)
+    if desc is None:
+        # nothing to edit, so skip parsing and re-serializing the EXIF
+        with open(abspath, "rb") as fp:
+            image_bytes = fp.read()
+    else:
+        edit = exif_write.ExifEdit(abspath)
+        edit.add_image_description(desc)
+        image_bytes = edit.dump_image_bytes()
+    return image_bytes, hashlib.blake2b(image_bytes, digest_size=16).digest()
 
 
 def _zip_sequence(
@@ -202,47 +259,73 @@ def _zip_sequence(
         sequences: T.Dict[str, types.FinalImageDescription],
         fp: T.IO[bytes],
         tqdm_desc: str = "Compressing",
-) -> str:
-    file_list = list(sequences.keys())
-    first_image = list(sequences.values())[0]
+        file_list: T.Optional[T.List[str]] = None,
+        root_dir: T.Optional[str] = None,
+        edit_exif: bool = False,
+) -> T.Tuple[str, int]:
+    """
+    :param file_list: the image paths of the sequence, if already known
+    :param root_dir: the common root of file_list, if already known
+    :param edit_exif: write each image's description into its EXIF; off by default
+        because it changes the sequence hash on every run
+    :return: the sequence hash and the number of bytes written to fp
+    """
+    if file_list is None:
+        file_list = list(sequences.keys())
 
-    root_dir = _find_root_dir(file_list)
     if root_dir is None:
-        sequence_uuid = first_image.get("SequenceUUID")
+        root_dir = _find_root_dir(file_list)
+    if root_dir is None:
+        sequence_uuid = next(iter(sequences.values())).get("SequenceUUID")
         raise RuntimeError(f"Unable to find the root dir of sequence {sequence_uuid}")
 
-    sequence_md5 = hashlib.md5()
+    # BLAKE2b is faster than MD5 on 64-bit CPUs; a 16-byte digest keeps the
+    # 32-hex session key format unchanged
+    sequence_hash = hashlib.blake2b(digest_size=16)
+    start = fp.tell()
 
-    file_list.sort(key=lambda path: sequences[path]["CaptureTime"])
+    file_list = sorted(file_list, key=lambda path: sequences[path]["CaptureTime"])
 
     # compressing
-    with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as ziph:
-        for file in tqdm(file_list, unit="files", desc=tqdm_desc):
-            relpath = os.path.relpath(file, root_dir)
-            abspath = os.path.join(image_dir, file)
-            edit = exif_write.ExifEdit(abspath)
-            # edit.add_image_description(sequences[file]) # comment because changing md5sum values each run
-            image_bytes = edit.dump_image_bytes()
-            sequence_md5.update(image_bytes)
-            ziph.writestr(relpath, image_bytes)
-
-    return sequence_md5.hexdigest()
+    # JPEGs are already compressed, so deflating them only burns CPU
+    with zipfile.ZipFile(fp, "w", zipfile.ZIP_STORED) as ziph, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor, \
+            tqdm(total=len(file_list), unit="files", desc=tqdm_desc) as pbar:
+        # images are read and hashed by the pool while this thread writes them
+        # in capture order; the window bounds how many images sit in memory
+        pending: T.Deque[T.Tuple[str, concurrent.futures.Future]] = collections.deque()
+
+        def _write_next():
+            file, future = pending.popleft()
+            image_bytes, digest = future.result()
+            sequence_hash.update(digest)
+            ziph.writestr(os.path.relpath(file, root_dir), image_bytes)
+            pbar.update(1)
+
+        for file in file_list:
+            desc = sequences[file] if edit_exif else None
+            pending.append((file, executor.submit(_read_image, image_dir, file, desc)))
+            if len(pending) >= READ_AHEAD_SIZE:
+                _write_next()
+        while pending:
+            _write_next()
+
+    # ZipFile leaves fp positioned after the central directory
+    return sequence_hash.hexdigest(), fp.tell() - start
 
 
 def upload_zipfile(zip_path: str, user_items: types.User, dry_run=False):
-    with zipfile.ZipFile(zip_path) as ziph:
-        namelist = ziph.namelist()
-
-    if not namelist:
-        raise RuntimeError(f"The zip file {zip_path} is empty")
-
     basename = os.path.basename(zip_path)
+    entity_size = os.path.getsize(zip_path)
     with open(zip_path, "rb") as fp:
-        fp.seek(0, io.SEEK_END)
-        entity_size = fp.tell()
+        with zipfile.ZipFile(fp) as ziph:
+            entry_count = len(ziph.infolist())
+
+        if not entry_count:
+            raise RuntimeError(f"The zip file {zip_path} is empty")
 
         # chunk size
-        avg_image_size = int(entity_size / len(namelist))
+        avg_image_size = entity_size // entry_count
         chunk_size = min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
 
         notifier = Notifier(
@@ -272,6 +355,9 @@ def is_retriable_exception(ex: Exception):
         return True
 
     if isinstance(ex, requests.HTTPError):
+        if ex.response.status_code == 429:
+            # throttled, the server expects us to come back later
+            return True
         if 400 <= ex.response.status_code < 500:
             try:
                 resp = ex.response.json()
@@ -284,6 +370,45 @@ def is_retriable_exception(ex: Exception):
     return False
 
 
+def _parse_retry_after(retry_after: str) -> Optional[float]:
+    """
+    :param retry_after: the Retry-After header, either seconds or an HTTP date
+    :return: seconds to wait, or None if the header is not usable
+    """
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        # a date in the past means the server is ready now
+        delay = max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+    if not math.isfinite(delay) or delay < 0:
+        return None
+    return delay
+
+
+def _retry_delay(ex: Exception, attempt: int) -> float:
+    """
+    :param ex: the retriable exception raised by the failed attempt
+    :param attempt: how many times in a row this kind of error has occurred
+    :return: seconds to wait before retrying
+    """
+    if isinstance(ex, requests.HTTPError):
+        retry_after = ex.response.headers.get("Retry-After")
+        if retry_after is not None:
+            delay = _parse_retry_after(retry_after)
+            if delay is not None:
+                return min(delay, MAX_RETRY_AFTER)
+        # give a failing server more room than a dropped connection
+        attempt += 2
+    # jitter keeps clients that failed together from retrying in lockstep
+    return 2 ** min(attempt, 5) * random.uniform(0.5, 1.5)
+
+
 def _upload_zipfile_fp(
         user_items: types.User,
         fp: T.IO[bytes],
@@ -297,7 +422,7 @@ def _upload_zipfile_fp(
         dry_run: bool = False,
 ) -> str:
     """
-    :param fp: the file handle to a zipped sequence file. Will always upload from the beginning
+    :param fp: the file handle to a zipped sequence file. Uploading resumes from the offset reported by the server
     :param entity_size: the size of the whole zipped sequence file
     :param session_key: the upload session key used to identify an upload
     :return: cluster ID
@@ -322,11 +447,14 @@ def _upload_zipfile_fp(
         )
 
     retries = 0
+    # consecutive failures per kind of error, each kind backs off on its own
+    retries_by_kind: T.Counter[str] = collections.Counter()
 
     # when it progresses, we reset retries
     def _reset_retries(_, __):
         nonlocal retries
         retries = 0
+        retries_by_kind.clear()
 
     while True:
         with tqdm(
@@ -336,12 +464,14 @@ def _upload_zipfile_fp(
                 unit_scale=True,
                 unit_divisor=1024,
         ) as pbar:
-            fp.seek(0, io.SEEK_SET)
             update_pbar = lambda chunk, _: pbar.update(len(chunk))
             try:
                 offset = upload_service.fetch_offset(email=user_items['SettingsUsername'])
-                # set the initial progress
-                pbar.update(offset)
+                # resume from where the server left off
+                fp.seek(offset, io.SEEK_SET)
+                if offset:
+                    # set the initial progress
+                    pbar.update(offset)
                 upload_service.callbacks = [
                     update_pbar,
                     _reset_retries,
@@ -356,9 +486,11 @@ def _upload_zipfile_fp(
             except Exception as ex:
                 if retries < 200 and is_retriable_exception(ex):
                     retries += 1
-                    sleep_for = min(2 ** retries, 16)
+                    kind = "http" if isinstance(ex, requests.HTTPError) else "connection"
+                    retries_by_kind[kind] += 1
+                    sleep_for = _retry_delay(ex, retries_by_kind[kind])
                     LOG.warning(
-                        f"Error uploading, resuming in {sleep_for} seconds",
+                        f"Error uploading, resuming in {sleep_for:.1f} seconds",
                         exc_info=True,
                     )
                     time.sleep(sleep_for)
@@ -387,24 +519,34 @@ def _zip_and_upload_single_sequence(
         return f"{desc} {sequence_idx + 1}/{total_sequences}"
 
     file_list = list(sequences.keys())
-    first_image = list(sequences.values())[0]
+    first_image = next(iter(sequences.values()))
     sequence_uuid = first_image.get("SequenceUUID")
 
     root_dir = _find_root_dir(file_list)
     if root_dir is None:
         raise RuntimeError(f"Unable to find the root dir of sequence {sequence_uuid}")
 
+    # stored zips are about as large as their images, so small sequences are
+    # zipped in memory and only large ones spill to a temporary file
+    images_size = sum(os.path.getsize(os.path.join(image_dir, file)) for file in file_list)
+    if images_size <= MAX_IN_MEMORY_ZIP_SIZE:
+        zip_file: T.IO[bytes] = io.BytesIO()
+    else:
+        zip_file = tempfile.NamedTemporaryFile(buffering=WRITE_BUFFER_SIZE)
+
     sequence_info = {}
-    with tempfile.NamedTemporaryFile() as fp:
-        sequence_md5 = _zip_sequence(
-            image_dir, sequences, fp, tqdm_desc=_build_desc("Compressing")
+    with zip_file as fp:
+        sequence_hash, entity_size = _zip_sequence(
+            image_dir,
+            sequences,
+            fp,
+            tqdm_desc=_build_desc("Compressing"),
+            file_list=file_list,
+            root_dir=root_dir,
         )
 
-        fp.seek(0, io.SEEK_END) # noqa
-        entity_size = fp.tell()
-
         # chunk size
-        avg_image_size = int(entity_size / len(sequences))
+        avg_image_size = entity_size // len(sequences)
         chunk_size = min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
 
         notifier = Notifier(
@@ -423,7 +565,7 @@ def _zip_and_upload_single_sequence(
             chunk_size,
             organization_key,
             project_key,
-            session_key=f"mapilio_tools_{sequence_md5}.zip",
+            session_key=f"mapilio_tools_{sequence_hash}.zip",
             tqdm_desc=_build_desc("Uploading"),
             notifier=notifier,
             dry_run=dry_run,